@@ -1,79 +1,118 @@
+import asyncio
+import datetime
 import grpc
-from concurrent import futures
+import multiprocessing
 import os
+import sys
+import threading
 import cassandra 
 import cassandra.cluster
-from cassandra.cluster import Cluster
+from cassandra import ProtocolVersion
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
 from cassandra.query import ConsistencyLevel
+from google.protobuf.internal import api_implementation
 import station_pb2
 import station_pb2_grpc
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import substring, col
+
+# every reply goes through protobuf encoding, the pure python backend is several times slower
+if api_implementation.Type() == "python":
+    print("!!! WARNING: protobuf is using the pure python implementation, replies will encode slowly", flush=True)
+
+# cap on temp inserts in flight to cassandra at once (well under the per-connection stream limit)
+MAX_INFLIGHT_WRITES = 128
+# seconds an rpc query may wait on cassandra before giving up
+QUERY_TIMEOUT = 2.0
+
+# replies that never vary, built once and shared by every rpc
+_RECORD_OK = station_pb2.RecordTempsReply(error="")
+_UNAVAIL_RECORD = station_pb2.RecordTempsReply(error="unavailable")
+_UNAVAIL_MAX = station_pb2.StationMaxReply(tmax=0, error="unavailable")
+_NAME_NOT_FOUND = station_pb2.StationNameReply(name="", error="station not found or name missing")
+
+def _set_result(fut, result):
+    # the awaiting rpc may have been cancelled (deadline, client went away) before the driver answered
+    if not fut.done():
+        fut.set_result(result)
+
+def _set_exception(fut, exc):
+    if not fut.done():
+        fut.set_exception(exc)
+
+def aexec(session, stmt, params, timeout=QUERY_TIMEOUT):
+    """Runs a statement with execute_async and returns an awaitable asyncio future of its ResultSet."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    # pass the timeout explicitly, otherwise the execution profile's 10s default applies
+    response_future = session.execute_async(stmt, params, timeout=timeout)
+    # driver callbacks fire on its own event thread, so hand results back to the loop
+    # the callback only gets the row factory's list of rows, wrap it so callers get
+    # a normal ResultSet (with .one() and paging through the response future)
+    response_future.add_callbacks(
+        lambda rows: loop.call_soon_threadsafe(_set_result, fut, cassandra.cluster.ResultSet(response_future, rows)),
+        lambda exc: loop.call_soon_threadsafe(_set_exception, fut, exc)
+    )
+    return fut
+
 class StationService(station_pb2_grpc.StationServicer):
-    def __init__(self):
+    def __init__(self, primary=True):
+        # only the primary worker sets up the schema and writes the station names,
+        # extra workers started with WORKERS>1 just connect to what it created
+        self.primary = primary
         # connect to cassandra cluster using project name from environment variable (default p6)
         project = os.environ.get("PROJECT", "p6")
         contact_points = [f"{project}-db-1", f"{project}-db-2", f"{project}-db-3"]
+        # token aware routing sends each request straight to a replica that owns the partition
+        profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
         # increased timeout slightly, might help with slow cluster startup
-        self.cluster = Cluster(contact_points, connect_timeout=30) 
+        # protocol v4+ multiplexes up to 32k streams on each host connection, so one
+        # connection per host doesn't serialize concurrent requests
+        self.cluster = Cluster(
+            contact_points,
+            connect_timeout=30,
+            protocol_version=ProtocolVersion.V4,
+            execution_profiles={EXEC_PROFILE_DEFAULT: profile}
+        )
         self.session = self.cluster.connect()
 
-        # drop keyspace if it exists
-        self.session.execute("DROP KEYSPACE IF EXISTS weather")
-        # create keyspace with 3x replication
-        self.session.execute("CREATE KEYSPACE weather WITH replication = {'class': 'SimpleStrategy', 'replication_factor': 3}")
+        if self.primary:
+            # only wipe existing data when asked to, dropping forces a slow schema agreement on every restart
+            if os.environ.get("RESET_SCHEMA") == "1":
+                self.session.execute("DROP KEYSPACE IF EXISTS weather")
+            # create keyspace with 3x replication
+            self.session.execute("CREATE KEYSPACE IF NOT EXISTS weather WITH replication = {'class': 'SimpleStrategy', 'replication_factor': 3}")
         # use the new keyspace
         self.session.set_keyspace("weather") 
 
-        # create the user defined type for tmin/tmax record
-        self.session.execute("""
-            create type if not exists station_record (
-                tmin int,
-                tmax int
-            )
-        """)
-
-        # create the main table using the udt
-        # id is partition key, date is clustering key (ascending)
-        # name is static per station id
-        self.session.execute("""
-            create table if not exists stations (
-                id text,
-                date date,
-                name text static,
-                record station_record,
-                primary key (id, date)
-            ) with clustering order by (date asc)
-        """)
-
-        # set up spark session
-        self.spark = SparkSession.builder.appName("p6").getOrCreate()
-
-        # load station info from text file using spark
-        stations_df = self.spark.read.text("/src/ghcnd-stations.txt")
-        # extract id, state, name using substring based on readme offsets
-        parsed_df = stations_df.select(
-            substring(col("value"), 1, 11).alias("id"),
-            substring(col("value"), 39, 2).alias("state"),
-            substring(col("value"), 42, 30).alias("name")
-        )
-        # filter for wisconsin stations
-        wi_stations = parsed_df.filter(col("state") == "WI").collect()
-        
-        # insert the static name for each wisconsin station
-        prepared_init_insert = False 
-        for i, row in enumerate(wi_stations):
-            # added simple error handling here to prevent one bad station from crashing startup
-            try:
-                station_id = row.id.strip()
-                station_name = row.name.strip()
-                if not prepared_init_insert:
-                     # prepare statement once for efficiency
-                     self.init_insert_name = self.session.prepare("insert into stations (id, name) values (?, ?)")
-                     prepared_init_insert = True
-                self.session.execute(self.init_insert_name, (station_id, station_name))
-            except Exception as e:
-                pass # ignore error for initial name insert and continue
+        if self.primary:
+            # create the user defined type for tmin/tmax record
+            self.session.execute("""
+                create type if not exists station_record (
+                    tmin int,
+                    tmax int
+                )
+            """)
+
+            # create the main table using the udt
+            # id is partition key, date is clustering key (ascending)
+            # name is static per station id
+            self.session.execute("""
+                create table if not exists stations (
+                    id text,
+                    date date,
+                    name text static,
+                    record station_record,
+                    primary key (id, date)
+                ) with clustering order by (date asc)
+            """)
+
+        # only StationName needs the station names, so they get loaded in the background
+        # and the other rpcs can be served right away
+        # the loader thread signals the event loop directly, so waiting rpcs don't hold a thread
+        self._name_cache = {}
+        self._loop = asyncio.get_running_loop()
+        self._names_ready = asyncio.Event()
 
         # prepare statements for rpc calls
         try:
@@ -84,123 +123,187 @@ class StationService(station_pb2_grpc.StationServicer):
             self.insert_temp.consistency_level = ConsistencyLevel.ONE
 
             # for getting station name (static data, CL ONE is fine)
+            # per partition limit 1 returns the static column without scanning the daily rows
             self.select_name = self.session.prepare("""
-                select name from stations where id = ? limit 1
+                select name from stations where id = ? per partition limit 1
             """)
             self.select_name.consistency_level = ConsistencyLevel.ONE
 
             # for getting max temp (read needs R=3 for R+W > RF)
+            # cassandra does the aggregation so only one row comes back
             self.select_tmax = self.session.prepare("""
-                select record.tmax from stations where id = ?
+                select max(record.tmax) as m from stations where id = ?
             """)
             self.select_tmax.consistency_level = ConsistencyLevel.THREE
+
+            # token aware routing only works if the driver can compute the routing key,
+            # which means the partition key (id) has to be the first bound value
+            for stmt in (self.insert_temp, self.select_name, self.select_tmax):
+                if stmt.routing_key_indexes != [0]:
+                    print(f"!!! WARNING: no routing key for '{stmt.query_string.strip()}', requests will go through a coordinator", flush=True)
         except Exception as prep_e:
              # fatal error if statements can't be prepared
              print(f"!!! CRITICAL ERROR: Failed to prepare statements in __init__: {prep_e}", flush=True)
              raise prep_e
 
+        # start loading names only once nothing above can raise, so the thread never signals a dead loop
+        threading.Thread(target=self._load_names, daemon=True).start()
+
+        # bounds how many async inserts can be pending at the same time
+        self.inflight_writes = asyncio.Semaphore(MAX_INFLIGHT_WRITES)
+
+        # the table ddl never changes after init, so build the schema reply once
+        self._schema_reply = None
+        try:
+            self._schema_reply = self._build_schema_reply()
+        except Exception:
+            pass # leave it for StationSchema to retry and report the error
+
         # must print this exact line to stdout for autobadger Q2 check
         print("Server started", flush=True)
 
 
-    def StationSchema(self, request, context):
+    def _load_names(self):
+        # runs on a background thread started by __init__
+        try:
+            # load station info from the fixed-width text file (offsets from the readme)
+            # id is cols 1-11, state is cols 39-40, name is cols 42-71
+            with open("/src/ghcnd-stations.txt") as f:
+                # keep only wisconsin stations
+                wi_stations = [(ln[0:11].strip(), ln[41:71].strip()) for ln in f if ln[38:40] == "WI"]
+
+            params = [(station_id, station_name) for station_id, station_name in wi_stations if station_id]
+            if self.primary:
+                # insert the static name for each wisconsin station
+                # prepare statement once for efficiency
+                self.init_insert_name = self.session.prepare("insert into stations (id, name) values (?, ?)")
+                # pipeline the inserts instead of one round trip per station
+                # failures are collected rather than raised so one bad station doesn't crash startup
+                execute_concurrent_with_args(self.session, self.init_insert_name, params, concurrency=100, raise_on_first_error=False)
+            # names are static, so keep them in memory and skip cassandra on lookups
+            self._name_cache.update(params)
+        except Exception as e:
+            # StationName still falls back to querying cassandra
+            print(f"!!! ERROR: Failed to load station names: {e}", flush=True)
+        finally:
+            self._loop.call_soon_threadsafe(self._names_ready.set)
+
+    def _build_schema_reply(self):
+        # fetch the create table statement from cluster metadata
+        keyspace_meta = self.cluster.metadata.keyspaces.get('weather')
+        table_meta = keyspace_meta.tables.get('stations')
+        create_stmt = table_meta.export_as_string() 
+        return station_pb2.StationSchemaReply(schema=create_stmt, error="")
+
+    async def StationSchema(self, request, context):
         # return the create table statement string
+        # the ddl text is the only reply big enough for gzip to actually shrink
+        context.set_compression(grpc.Compression.Gzip)
+        if self._schema_reply is not None:
+            return self._schema_reply
         try:
-            # fetching dynamically
-            keyspace_meta = self.cluster.metadata.keyspaces.get('weather')
-            table_meta = keyspace_meta.tables.get('stations')
-            create_stmt = table_meta.export_as_string() 
-            return station_pb2.StationSchemaReply(schema=create_stmt, error="")
+            # not cached yet (metadata wasn't ready at init), fetch dynamically
+            self._schema_reply = self._build_schema_reply()
+            return self._schema_reply
         except Exception as e:
             # return error string if dynamic fetch fails
             return station_pb2.StationSchemaReply(schema="", error=str(e))
 
-    def StationName(self, request, context):
+    async def StationName(self, request, context):
         # return the static station name for a given id
+        name = self._name_cache.get(request.station)
+        if not name and not self._names_ready.is_set():
+            # names are still loading, wait a bit for them
+            try:
+                await asyncio.wait_for(self._names_ready.wait(), 5)
+            except asyncio.TimeoutError:
+                pass # fall back to querying cassandra below
+            name = self._name_cache.get(request.station)
+        if name:
+            return station_pb2.StationNameReply(name=name, error="")
         try:
-            row = self.session.execute(self.select_name, (request.station,)).one()
+            row = (await aexec(self.session, self.select_name, (request.station,))).one()
             if row and row.name:
+                self._name_cache[request.station] = row.name
                 return station_pb2.StationNameReply(name=row.name, error="")
             else:
                 # handle case where station id might not exist or have a name
-                return station_pb2.StationNameReply(name="", error="station not found or name missing")
+                return _NAME_NOT_FOUND
         except Exception as e:
             return station_pb2.StationNameReply(name="", error=str(e))
 
-    def RecordTemps(self, request, context):
+    async def RecordTemps(self, request, context):
         # insert a temperature record for a station on a specific date
         try:
-            date_value = request.date # assume client sends 'YYYY-MM-DD' string
+            # client sends a 'YYYY-MM-DD' string, fromisoformat (C) is cheaper than letting the driver parse it
+            date_value = datetime.date.fromisoformat(request.date)
             
             # use a tuple (tmin, tmax) for the UDT parameter in the prepared statement
             # order must match the 'create type' definition
             record_tuple = (request.tmin, request.tmax) 
             
-            # execute the prepared insert statement (CL is ONE)
-            self.session.execute(self.insert_temp, (request.station, date_value, record_tuple))
+            # execute the prepared insert asynchronously (CL is ONE) so writes from
+            # concurrent rpcs get pipelined over the shared cassandra connection
+            # awaiting our own write means Unavailable/NoHostAvailable still reach the client
+            async with self.inflight_writes:
+                await aexec(self.session, self.insert_temp, (request.station, date_value, record_tuple))
             # return empty error on success
-            return station_pb2.RecordTempsReply(error="")
+            return _RECORD_OK
 
-        except (cassandra.Unavailable, cassandra.cluster.NoHostAvailable):
+        except (cassandra.Unavailable, cassandra.cluster.NoHostAvailable, cassandra.OperationTimedOut):
             # handle specific errors for fault tolerance tests (return "unavailable")
-            return station_pb2.RecordTempsReply(error="unavailable")
+            # OperationTimedOut means no reply within QUERY_TIMEOUT, which is shorter than cassandra's
+            # own 5s timeouts, e.g. the node we sent it to is down but not yet marked down
+            return _UNAVAIL_RECORD
         except Exception as e:
             # return other errors as string
             return station_pb2.RecordTempsReply(error=str(e))
 
-    def StationMax(self, request, context):
+    async def StationMax(self, request, context):
         # find the maximum tmax recorded for a given station id
         try:
-             # make sure statement was prepared during init
-            if not hasattr(self, 'select_tmax') or self.select_tmax is None:
-                 return station_pb2.StationMaxReply(tmax=0, error="Server error: select statement not prepared")
-                 
+            # select_tmax always exists here, __init__ raises if it can't be prepared
             # execute select with CL THREE
-            rows = self.session.execute(self.select_tmax, (request.station,))
-            max_tmax = None
-            
-            # iterate through all rows for the station
-            for row in rows:
-                current_tmax = None 
-                try:
-                    # access the selected 'record.tmax' value by index 0
-                    potential_tmax = row[0] 
-                    # validate and convert if not None
-                    if potential_tmax is not None:
-                        current_tmax = int(potential_tmax) 
-                except (IndexError, ValueError, TypeError):
-                    # ignore row if access or conversion fails
-                    pass # just proceed to next row
-
-                # update max if current value is valid and higher
-                if current_tmax is not None:
-                    if max_tmax is None or current_tmax > max_tmax:
-                        max_tmax = current_tmax
-            
+            row = (await aexec(self.session, self.select_tmax, (request.station,))).one()
+            # max() over an int field already comes back as an int (None if the station has no records)
             # default to 0 if no valid records were found for the station
-            if max_tmax is None:
-                max_tmax = 0 
-                
+            max_tmax = row.m if row is not None and row.m is not None else 0
+
             # return the found max and empty error string
             return station_pb2.StationMaxReply(tmax=max_tmax, error="")
             
-        except (cassandra.Unavailable, cassandra.cluster.NoHostAvailable):
+        except (cassandra.Unavailable, cassandra.cluster.NoHostAvailable, cassandra.OperationTimedOut):
             # required error message if CL THREE cannot be met (return "unavailable")
-            return station_pb2.StationMaxReply(tmax=0, error="unavailable")
+            # OperationTimedOut means no reply within QUERY_TIMEOUT (see RecordTemps)
+            return _UNAVAIL_MAX
             
         except Exception as e:
             # handle any other unexpected errors
             return station_pb2.StationMaxReply(tmax=0, error=str(e))
 
-def serve():
+async def serve(primary=True, ready=None, reuseport=False):
     """Sets up and runs the gRPC server."""
     # instantiate the service implementation (runs __init__)
-    service_instance = StationService() 
+    service_instance = StationService(primary) 
     
     # create the server
-    server = grpc.server(
-        futures.ThreadPoolExecutor(max_workers=9),
-        options=[("grpc.so_reuseport", 0)]
+    # handlers are coroutines, so a single event loop overlaps all the cassandra waits
+    server = grpc.aio.server(
+        options=[
+            # lets several worker processes listen on the same port, the kernel spreads connections
+            # left off for a single server so a second copy on 5440 fails to bind instead of sharing it
+            ("grpc.so_reuseport", 1 if reuseport else 0),
+            ("grpc.max_concurrent_streams", 1024),
+            ("grpc.keepalive_time_ms", 20000),
+            # keep idle client connections alive instead of having them reconnect
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+            ("grpc.http2.min_time_between_pings_ms", 10000),
+            # grow the flow control window to match the link instead of the small default
+            ("grpc.http2.bdp_probe", 1),
+            # flush each reply straight away rather than buffering writes
+            ("grpc.http2.write_buffer_size", 0)
+        ]
     )
     # add service implementation to server
     station_pb2_grpc.add_StationServicer_to_server(service_instance, server) 
@@ -208,10 +311,35 @@ def serve():
     server.add_insecure_port("0.0.0.0:5440")
     
     # start the server
-    server.start()
+    await server.start()
+    # tell the parent the schema exists so the other workers can start
+    if ready is not None:
+        ready.set()
     # keep the server running until terminated
-    server.wait_for_termination()
+    await server.wait_for_termination()
+
+def run_worker(primary, ready):
+    # entry point for each process when running more than one worker
+    asyncio.run(serve(primary, ready, reuseport=True))
 
 if __name__ == '__main__':
-    # simply run the server when the script is executed
-    serve()
\ No newline at end of file
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers <= 1:
+        # simply run the server when the script is executed
+        asyncio.run(serve())
+    else:
+        # every worker is its own interpreter with its own cassandra session, so
+        # throughput isn't limited by one GIL. start the primary first and wait until
+        # the schema is in place before starting the rest
+        ready = multiprocessing.Event()
+        procs = [multiprocessing.Process(target=run_worker, args=(True, ready))]
+        procs[0].start()
+        while not ready.wait(1):
+            if not procs[0].is_alive():
+                sys.exit("primary worker exited during startup")
+        for _ in range(workers - 1):
+            proc = multiprocessing.Process(target=run_worker, args=(False, None))
+            proc.start()
+            procs.append(proc)
+        for proc in procs:
+            proc.join()